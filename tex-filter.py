@@ -2,10 +2,11 @@
 """Remove unneeded info from TeX's stdout."""
 
 import sys
+import io
+import os
 import re
 import subprocess
 import argparse
-from collections import namedtuple
 
 
 FILE_FORMATS = "sty|tex|cfg|def|clo|fd|mkii|pfb|enc|map|cls|otf|ldf|tikz|aux|out|bbl|ltx|sto|ttf|dict"
@@ -14,7 +15,10 @@ LOCAL_PATH_PATTERN = r'./[a-zA-Z0-9\-_\/\.]+\.(' + FILE_FORMATS + ')'
 PATH_STUB = '#'
 PATH_STUB_PATTERN = r'\(#[\(#\) ]*\)'
 PATH_STUB_PATTERN_2 = r'[\(#\) ]+'
+WRAPPED_PATH_STUBS = ('<' + PATH_STUB + '>', '{' + PATH_STUB + '}')
 VBOX_SUFFIX = r'has occurred while \\output is active'
+OVERFULL_VBOX_PATTERN = r'Overfull \\vbox \([0-9\.]+pt too high\) ' + VBOX_SUFFIX
+UNDERFULL_VBOX_PATTERN = r'Underfull \\vbox \(badness \d+\) ' + VBOX_SUFFIX
 
 BAD_STRS = tuple("""
  ABD: EveryShipout initializing macros
@@ -67,6 +71,21 @@ CITEREF_PATTERN = (r"(LaTeX|Package natbib) Warning: (Citation|Reference|Hyper r
 LATEX_FONT_WARN_1 = r"LaTeX Font Warning: Font shape `[\w\/]+' (undefined|in size <[0-9\.]+> not available)"  # noqa
 LATEX_FONT_WARN_2 = r"\(Font\)\s+(size <[0-9\.]+> substituted|using `[\w\/]+' instead) on input line \d+."  # noqa
 
+
+def alternation(patterns):
+    return '|'.join('(?:' + pattern + ')' for pattern in patterns)
+
+
+_PATH_STUB_RE = re.compile(PATH_STUB_PATTERN)
+_PATH_STUB2_RE = re.compile('(?:' + PATH_STUB_PATTERN_2 + r')\Z')
+_LOCAL_PATH_RE = re.compile(LOCAL_PATH_PATTERN)
+_PAGENUM_RE = re.compile(r'\s*\[[0-9\.]+\]')
+_PARENS_RE = re.compile(r'[\(\) ]+\Z')
+_BAD_STRS_RE = re.compile('|'.join(map(re.escape, BAD_STRS))) if BAD_STRS else None
+_BAD_PATTERNS_RE = re.compile(alternation(BAD_PATTERNS))
+
+OUTPUT_BUFFER_SIZE = 1 << 16
+
 FILTERS = {
     'local_paths': (False, 'replace all local paths by a stub'),
     'std_paths': (True, 'replace paths of pre-installed fonts, packages, etc. by a stub'),
@@ -86,82 +105,162 @@ FILTERS = {
 }
 
 
+def get_prefix_cache_path():
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'tex-filter', 'prefix')
+
+
+def find_executable(name):
+    """Returns the resolved path of the program that running `name` would start, or ''."""
+    exts = os.environ.get('PATHEXT', '').split(os.pathsep) if os.name == 'nt' else []
+    for dirname in os.environ.get('PATH', '').split(os.pathsep):
+        for filename in [name] + [name + ext for ext in exts if ext]:
+            path = os.path.join(dirname, filename)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return os.path.realpath(path)
+    return ''
+
+
 def get_prefix():
     """
     Finds the directory containing TeX fonts, classes, packages, etc.
     It should look something like '/usr/local/texlive/2020' or '/usr/share/texlive'.
+    The TEX_FILTER_PREFIX environment variable overrides this.
+    Otherwise, since running kpsewhich is slow, its answer is cached. The cache is keyed by
+    everything that can change that answer: the resolved kpsewhich binary, $TEXMFDIST and $TEXMFCNF.
     """
+    prefix = os.environ.get('TEX_FILTER_PREFIX')
+    if prefix:
+        return prefix.rstrip('/')
     suffix = '/texmf-dist/fonts/type1/public/amsfonts/cm/cmr10.pfb'
+    cache_path = get_prefix_cache_path()
+    cache_key = [find_executable('kpsewhich'), os.environ.get('TEXMFDIST', ''),
+        os.environ.get('TEXMFCNF', '')]
+    try:
+        with open(cache_path) as fp:
+            values = fp.read().split('\n')
+        prefix = values[len(cache_key)]
+        if values[:len(cache_key)] == cache_key and os.path.isfile(prefix + suffix):
+            return prefix
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
     path = subprocess.check_output(['kpsewhich', 'cmr10.pfb'], universal_newlines=True).strip()
     if not path.endswith(suffix):
         raise ValueError("cmr10.pfb's path is non-standard")
-    return path[:-len(suffix)]
-
-
-LineState = namedtuple('LineState', ['full_hbox', 'words_of_mem'])
-
-
-def fullmatch(pattern, string, flags=0):
-    m = re.match(pattern, string, flags=flags)
-    if m and m.end() == len(string):
-        return m
+    prefix = path[:-len(suffix)]
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        with open(cache_path, 'w') as fp:
+            fp.write('\n'.join(cache_key + [prefix]) + '\n')
+    except (IOError, OSError, ValueError):
+        pass
+    return prefix
 
 
 def clean_file(ifp, ofp, std_path_prefix, filters):
     errcode = 0
-    std_path_pattern = std_path_prefix + UNPREFIXED_STD_PATH_PATTERN
-    prev_state = LineState(False, False)
+    std_path_re = re.compile(std_path_prefix + UNPREFIXED_STD_PATH_PATTERN)
+    vbox_patterns = [pattern for name, pattern in (('ofull_vbox', OVERFULL_VBOX_PATTERN),
+        ('ufull_vbox', UNDERFULL_VBOX_PATTERN)) if filters[name]]
+    vbox_re = re.compile(alternation(vbox_patterns)) if vbox_patterns else None
+    # lines to drop, found by a single regex anchored at the start of the line
+    discard_patterns = []
+    if filters['bad_lines']:
+        discard_patterns.append('|'.join(map(re.escape, BAD_LINES)))
+    if filters['citeref']:
+        discard_patterns.append(CITEREF_PATTERN)
+    if filters['font']:
+        discard_patterns.append('(?:' + alternation([LATEX_FONT_WARN_1, LATEX_FONT_WARN_2]) + r')\Z')
+    discard_re = re.compile(r'\A(?:' + alternation(discard_patterns) + ')') if discard_patterns else None
+
+    # filters don't change while reading, so look them up once
+    f_full_hbox_details = filters['full_hbox_details']
+    f_ofull_hbox = filters['ofull_hbox']
+    f_ufull_hbox = filters['ufull_hbox']
+    f_words_of_mem = filters['words_of_mem']
+    f_bad_strs = filters['bad_strs'] and _BAD_STRS_RE is not None
+    f_bad_patterns = filters['bad_strs']
+    f_std_paths = filters['std_paths']
+    f_local_paths = filters['local_paths']
+    f_path_stubs = filters['path_stubs']
+    f_page_numbers = filters['page_numbers']
+    f_empty_lines = filters['empty_lines']
+    discard_match = discard_re.match if discard_re is not None else None
+    bad_strs_sub = _BAD_STRS_RE.sub if f_bad_strs else None
+    bad_patterns_sub = _BAD_PATTERNS_RE.sub
+    vbox_sub = vbox_re.sub if vbox_re is not None else None
+    std_path_sub = std_path_re.sub
+    local_path_sub = _LOCAL_PATH_RE.sub
+    path_stub_sub = _PATH_STUB_RE.sub
+    pagenum_sub = _PAGENUM_RE.sub
+    # lines made up only of leftover brackets (and path stubs) get blanked
+    junk_match = (_PATH_STUB2_RE if f_path_stubs else _PARENS_RE).match
+
+    prev_full_hbox = prev_words_of_mem = False
     prev_is_empty = True
-    for line in ifp:
-        if line.startswith('! '):
-            errcode = 1
-        line = line.strip()
-        has_ofull_hbox = line.startswith('Overfull \\hbox')
-        has_ufull_hbox = line.startswith('Underfull \\hbox')
-        words_of_mem = 'words of node memory still in use' in line
-        state = LineState(has_ofull_hbox or has_ufull_hbox, words_of_mem)
-        discard = ((filters['full_hbox_details'] and prev_state.full_hbox)
-            or (filters['ofull_hbox'] and has_ofull_hbox)  # noqa
-            or (filters['ufull_hbox'] and has_ufull_hbox)  # noqa
-            or (filters['font'] and (fullmatch(LATEX_FONT_WARN_1, line)  # noqa
-                or fullmatch(LATEX_FONT_WARN_2, line)))  # noqa
-            or (filters['citeref'] and re.match(CITEREF_PATTERN, line))  # noqa
-            or (filters['bad_lines'] and line.startswith(BAD_LINES))  # noqa
-            or (filters['words_of_mem'] and (state.words_of_mem or prev_state.words_of_mem))  # noqa
-            )
-        if not discard:
-            if filters['bad_strs']:
-                for s in BAD_STRS:
+    # flush every line only if someone is watching; otherwise write in large chunks
+    interactive = ofp.isatty()
+    out, out_size = [], 0
+    out_append = out.append
+    try:
+        for line in ifp:
+            if line.startswith('! '):
+                errcode = 1
+            line = line.strip()
+            has_ofull_hbox = line.startswith('Overfull \\hbox')
+            has_ufull_hbox = line.startswith('Underfull \\hbox')
+            words_of_mem = f_words_of_mem and 'words of node memory still in use' in line
+            after_full_hbox, after_words_of_mem = prev_full_hbox, prev_words_of_mem
+            prev_full_hbox = has_ofull_hbox or has_ufull_hbox
+            prev_words_of_mem = words_of_mem
+            # drop the line as soon as one check says so, cheapest checks first
+            if f_full_hbox_details and after_full_hbox:
+                continue
+            if (f_ofull_hbox and has_ofull_hbox) or (f_ufull_hbox and has_ufull_hbox):
+                continue
+            if words_of_mem or after_words_of_mem:
+                continue
+            if discard_match is not None and discard_match(line) is not None:
+                continue
+            if f_bad_strs:
+                line = bad_strs_sub('', line)
+            # cheap substring checks that every match of BAD_PATTERNS must pass
+            if f_bad_patterns and ('Excluding' in line or 'pdfTeX warning' in line
+                    or '.aux)' in line or '.out)' in line or 'Library (tcolorbox)' in line
+                    or 'warning  (pdf backend)' in line):
+                line = bad_patterns_sub('', line)
+            if vbox_sub is not None and 'vbox' in line:
+                line = vbox_sub('', line)
+            if f_std_paths and '/texmf-' in line:
+                line = std_path_sub(PATH_STUB, line)
+            if f_local_paths and '/' in line:
+                line = local_path_sub(PATH_STUB, line)
+            if f_path_stubs and PATH_STUB in line:
+                line = path_stub_sub('', line)
+                for s in WRAPPED_PATH_STUBS:
                     line = line.replace(s, '')
-                for s in BAD_PATTERNS:
-                    line = re.sub(s, '', line)
-            if filters['ofull_vbox']:
-                line = re.sub(r'Overfull \\vbox \([0-9\.]+pt too high\) ' + VBOX_SUFFIX, '', line)
-            if filters['ufull_vbox']:
-                line = re.sub(r'Underfull \\vbox \(badness \d+\) ' + VBOX_SUFFIX, '', line)
-            if filters['std_paths']:
-                line = re.sub(std_path_pattern, PATH_STUB, line)
-            if filters['local_paths']:
-                line = re.sub(LOCAL_PATH_PATTERN, PATH_STUB, line)
-            if filters['path_stubs']:
-                line = re.sub(PATH_STUB_PATTERN, '', line)
-                if fullmatch(PATH_STUB_PATTERN_2, line):
-                    line = ''
-                line = line.replace('<' + PATH_STUB + '>', '')
-                line = line.replace('{' + PATH_STUB + '}', '')
-            if filters['page_numbers']:
-                line = re.sub(r'\s*\[[0-9\.]+\]', '', line)
-            if filters['path_stubs']:
-                if fullmatch(PATH_STUB_PATTERN_2, line):
-                    line = ''
-            if fullmatch(r'[\(\) ]+', line):
+            if f_page_numbers and '[' in line:
+                line = pagenum_sub('', line)
+            if junk_match(line):
                 line = ''
             line = line.strip()
-            if not(line == '' and (filters['empty_lines'] or prev_is_empty)):
-                ofp.write(line + '\n')
-                ofp.flush()
+            if not(line == '' and (f_empty_lines or prev_is_empty)):
+                out_append(line)
+                out_size += len(line) + 1
+                if interactive or out_size >= OUTPUT_BUFFER_SIZE:
+                    # detach the batch first, so that finally doesn't write it again if this fails
+                    chunk = '\n'.join(out) + '\n'
+                    del out[:]
+                    out_size = 0
+                    ofp.write(chunk)
+                    ofp.flush()
             prev_is_empty = line == ''
-        prev_state = state
+    finally:
+        if out:
+            ofp.write('\n'.join(out) + '\n')
+        ofp.flush()
     return errcode
 
 
@@ -176,7 +275,16 @@ def main():
 
     prefix = get_prefix()
     filters = {name: bool(value) for name, value in vars(args).items()}
-    errcode = clean_file(sys.stdin, sys.stdout, prefix, filters)
+    ifp, ofp = sys.stdin, sys.stdout
+    if hasattr(sys.stdin, 'buffer'):
+        # TeX's output need not be valid in the locale's encoding; pass such bytes through as-is.
+        # Split lines the way sys.stdin/sys.stdout do: only at '\n', except on Windows.
+        newline = None if os.name == 'nt' else '\n'
+        ifp = io.TextIOWrapper(sys.stdin.buffer, encoding=sys.stdin.encoding,
+            errors='surrogateescape', newline=newline)
+        ofp = io.TextIOWrapper(sys.stdout.buffer, encoding=sys.stdout.encoding,
+            errors='surrogateescape', newline=newline)
+    errcode = clean_file(ifp, ofp, prefix, filters)
     if args.detect_error:
         sys.exit(errcode)
 